@@ -0,0 +1,125 @@
+import os
+import json
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows: admission is then only coordinated within one process
+    fcntl = None
+
+
+class AdmissionTimeout(RuntimeError):
+    pass
+
+
+class AdmissionController:
+    """Memory budget shared by all workers on a host.
+
+    Each job reserves its estimated peak memory before it starts. Jobs that do
+    not fit wait in FIFO order until running jobs release their reservations.
+    The ledger is a small JSON file guarded by an flock, so every gunicorn
+    worker sees the same usage and queue.
+    """
+
+    def __init__(self, budget_bytes, state_path, timeout_s=60.0, poll_s=0.25):
+        self.budget_bytes = int(budget_bytes)
+        self.state_path = state_path
+        self.lock_path = state_path + ".lock"
+        self.timeout_s = timeout_s
+        self.poll_s = poll_s
+        self._thread_lock = threading.Lock()
+
+    @contextmanager
+    def _locked_state(self):
+        with self._thread_lock:
+            with open(self.lock_path, "a+") as lock_file:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    with open(self.state_path, "r") as f:
+                        state = json.load(f)
+                except (FileNotFoundError, ValueError):
+                    state = {"running": {}, "waiting": []}
+                loaded = json.dumps(state, sort_keys=True)
+                self._prune(state)
+                yield state
+                # Polls and status() reads usually change nothing; skip the write
+                if json.dumps(state, sort_keys=True) == loaded:
+                    return
+                tmp_path = f"{self.state_path}.{os.getpid()}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(state, f)
+                os.replace(tmp_path, self.state_path)
+
+    @staticmethod
+    def _prune(state):
+        # Drop reservations left behind by workers that were killed mid-job
+        if os.name != "posix":
+            return
+        alive = {}
+        def is_alive(pid):
+            if pid not in alive:
+                try:
+                    os.kill(pid, 0)
+                    alive[pid] = True
+                except ProcessLookupError:
+                    alive[pid] = False
+                except PermissionError:
+                    alive[pid] = True
+            return alive[pid]
+        state["running"] = {t: j for t, j in state["running"].items() if is_alive(j["pid"])}
+        state["waiting"] = [j for j in state["waiting"] if is_alive(j["pid"])]
+
+    def acquire(self, nbytes):
+        """Block until `nbytes` fit in the budget; return a reservation token."""
+        token = uuid.uuid4().hex
+        entry = {"token": token, "bytes": int(nbytes), "pid": os.getpid(), "since": time.time()}
+        deadline = time.monotonic() + self.timeout_s
+        with self._locked_state() as state:
+            state["waiting"].append(entry)
+        try:
+            while True:
+                with self._locked_state() as state:
+                    used = sum(j["bytes"] for j in state["running"].values())
+                    is_head = state["waiting"] and state["waiting"][0]["token"] == token
+                    # An idle host always admits the head job so oversize estimates cannot deadlock
+                    if is_head and (used + entry["bytes"] <= self.budget_bytes or not state["running"]):
+                        state["waiting"].pop(0)
+                        state["running"][token] = entry
+                        return token
+                if time.monotonic() >= deadline:
+                    raise AdmissionTimeout(
+                        f"Timed out after {self.timeout_s:.0f}s waiting for "
+                        f"{entry['bytes'] / 2**20:.0f} MB of image processing memory."
+                    )
+                time.sleep(self.poll_s)
+        except BaseException:
+            with self._locked_state() as state:
+                state["waiting"] = [j for j in state["waiting"] if j["token"] != token]
+            raise
+
+    def release(self, token):
+        with self._locked_state() as state:
+            state["running"].pop(token, None)
+
+    @contextmanager
+    def reserve(self, nbytes):
+        token = self.acquire(nbytes)
+        try:
+            yield token
+        finally:
+            self.release(token)
+
+    def status(self):
+        with self._locked_state() as state:
+            used = sum(j["bytes"] for j in state["running"].values())
+            return {
+                "budget_bytes": self.budget_bytes,
+                "used_bytes": used,
+                "available_bytes": max(self.budget_bytes - used, 0),
+                "running_jobs": len(state["running"]),
+                "queue_depth": len(state["waiting"]),
+            }
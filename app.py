@@ -1,19 +1,17 @@
-from flask import Flask, render_template, request, send_file, redirect, url_for, session
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from reportlab.lib.units import mm
-from reportlab.lib import colors
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image as ReportLabImage
-from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
+from flask import Flask, render_template, request, send_file, redirect, url_for, session, make_response, jsonify
 from werkzeug.utils import secure_filename
-from image_processor import process_slab_image
 from datetime import datetime
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+from admission import AdmissionController, AdmissionTimeout
 import os
+import re
 import json
 import time
+import hashlib
+import functools
+import urllib.parse
+import secrets
+import mimetypes
+import tempfile
 import logging
 
 # Flask setup
@@ -26,6 +24,44 @@ os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 app.config["UPLOAD_FOLDER"] = UPLOAD_FOLDER
 app.config["OUTPUT_FOLDER"] = OUTPUT_FOLDER
 
+# Download offload: '' (Flask streams the file), 'x-sendfile' (Apache/lighttpd)
+# or 'x-accel' (nginx internal location mapped to OUTPUT_FOLDER). With x-accel,
+# nginx generates its own mtime/size ETag and handles conditional and Range
+# requests, so the content-hash ETag is not computed in that mode.
+FILE_OFFLOAD = os.getenv('FILE_OFFLOAD', '').lower()
+X_ACCEL_PREFIX = os.getenv('X_ACCEL_PREFIX', '/protected-outputs')
+app.config["USE_X_SENDFILE"] = FILE_OFFLOAD == 'x-sendfile'
+
+# Generated artifacts carry a _YYYYmmdd_HHMMSS_<random hex> suffix, so a name is
+# never reused for different content. Older names without the random part can
+# collide within a second and are only cached with revalidation.
+UNIQUE_ARTIFACT = re.compile(r'_\d{8}_\d{6}_[0-9a-f]{8}(_info)?\.[A-Za-z0-9]+$')
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+# Number of content-hash ETags kept per worker (LRU)
+ETAG_CACHE_SIZE = 1024
+
+# OpenCV/NumPy (image_processor), ReportLab and smtplib are imported on first
+# use. Set PRELOAD_HEAVY=1 (with gunicorn --preload) to import them and warm the
+# shared detector and PDF styles once in the master, so forked workers share
+# those pages copy-on-write instead of each paying the import cost.
+PRELOAD_HEAVY = os.getenv('PRELOAD_HEAVY', '0') == '1'
+
+# Sample stylesheet reused across reports
+_pdf_styles = None
+
+# Memory budget for concurrent slab processing, shared by all workers on the host.
+# Jobs whose estimated peak exceeds it are decoded at reduced size; others queue
+# until it fits. The queue wait happens inside the request and nothing in the app
+# server bounds it: with gunicorn threads (gthread) the worker timeout is only a
+# liveness heartbeat. The Heroku router cuts requests at 30s, so the wait must
+# stay well below that to leave time for processing and PDF generation.
+MEMORY_BUDGET_MB = int(os.getenv('MEMORY_BUDGET_MB', '350'))
+ADMISSION_TIMEOUT_S = float(os.getenv('ADMISSION_TIMEOUT_S', '20'))
+ADMISSION_STATE_FILE = os.getenv('ADMISSION_STATE_FILE', os.path.join(tempfile.gettempdir(), 'lifestone_admission.json'))
+admission_controller = AdmissionController(MEMORY_BUDGET_MB * 1024 * 1024, ADMISSION_STATE_FILE, ADMISSION_TIMEOUT_S)
+
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 app.logger.setLevel(logging.DEBUG)
@@ -40,6 +76,10 @@ ADMIN_EMAIL = "myemail@gmail.com"  # Replace with your email address
 ALLOWED_LOGO_EXTENSIONS = {'.png', '.jpg', '.jpeg'}
 MAX_LOGO_SIZE = 1 * 1024 * 1024  # 1MB in bytes
 
+# Size limit for live camera preview frames (512KB), plus room for multipart framing
+MAX_PREVIEW_FRAME_SIZE = 512 * 1024  # bytes
+MAX_PREVIEW_REQUEST_SIZE = MAX_PREVIEW_FRAME_SIZE + 16 * 1024  # bytes
+
 # Initialize activity log
 def init_activity_log():
     if not os.path.exists(ACTIVITY_LOG_FILE):
@@ -73,6 +113,10 @@ def update_activity_log(tester_email, timestamp, serial_number):
 
 # Send activity log to admin
 def send_activity_log_to_admin(log_data):
+    import smtplib
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+
     msg = MIMEMultipart()
     msg['From'] = os.getenv('SMTP_EMAIL', 'myemail@gmail.com')  # Replace with your SMTP email
     msg['To'] = ADMIN_EMAIL
@@ -96,13 +140,57 @@ def send_activity_log_to_admin(log_data):
         server.login(os.getenv('SMTP_EMAIL', 'myemail@gmail.com'), os.getenv('SMTP_PASSWORD', 'your-app-password'))
         server.send_message(msg)
 
+# Strong ETag from the file's SHA-256, hashed once per file version
+def file_etag(file_path):
+    st = os.stat(file_path)
+    return _hash_file(file_path, st.st_mtime_ns, st.st_size)
+
+# (mtime_ns, size) are part of the key so a rewritten file is hashed again
+@functools.lru_cache(maxsize=ETAG_CACHE_SIZE)
+def _hash_file(file_path, mtime_ns, size):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
 # Validate logo file
 def allowed_logo_file(filename):
     return '.' in filename and os.path.splitext(filename)[1].lower() in ALLOWED_LOGO_EXTENSIONS
 
+# Build the ReportLab stylesheet once per process
+def get_pdf_styles():
+    global _pdf_styles
+    if _pdf_styles is None:
+        from reportlab.lib.styles import getSampleStyleSheet
+        styles = getSampleStyleSheet()
+        styles['Heading1'].alignment = 1  # Center
+        styles['Heading3'].alignment = 1
+        styles['Normal'].spaceAfter = 12
+        _pdf_styles = styles
+    return _pdf_styles
+
+# Import heavy modules and build shared objects ahead of the first request
+def warm_up():
+    import image_processor
+    image_processor.get_detector()
+    get_pdf_styles()
+    import reportlab.platypus
+    import reportlab.pdfgen.canvas
+    import smtplib
+    import email.mime.multipart
+    app.logger.info("Heavy modules preloaded")
+
 # PDF generation with ReportLab
-def generate_pdf(serial_number, timestamp, data, output_image_path, support_images, company_logo_path=None, company_name=None, is_calibrated=True):
-    pdf_path = os.path.join(app.config['OUTPUT_FOLDER'], f"report_{serial_number}_{timestamp}.pdf")
+def generate_pdf(serial_number, artifact_id, data, output_image_path, support_images, company_logo_path=None, company_name=None, is_calibrated=True):
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.units import mm
+    from reportlab.lib import colors
+    from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, Image as ReportLabImage
+    from reportlab.lib.styles import ParagraphStyle
+
+    pdf_path = os.path.join(app.config['OUTPUT_FOLDER'], f"report_{serial_number}_{artifact_id}.pdf")
     doc = SimpleDocTemplate(pdf_path, pagesize=A4, rightMargin=20*mm, leftMargin=20*mm, topMargin=20*mm, bottomMargin=20*mm)
     
     # Define header and footer
@@ -117,13 +205,10 @@ def generate_pdf(serial_number, timestamp, data, output_image_path, support_imag
     elements = []
 
     # Styles
-    styles = getSampleStyleSheet()
+    styles = get_pdf_styles()
     title_style = styles['Heading1']
-    title_style.alignment = 1  # Center
     subtitle_style = styles['Heading3']
-    subtitle_style.alignment = 1
     normal_style = styles['Normal']
-    normal_style.spaceAfter = 12
     warning_style = ParagraphStyle(name='WarningStyle', fontSize=8, textColor=colors.red, alignment=1)
 
     # Header with company logo and name (or placeholder)
@@ -285,6 +370,8 @@ def confirm():
 
     # Collect form data
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    # Unique per submission so generated artifacts are never overwritten
+    artifact_id = f"{timestamp}_{secrets.token_hex(4)}"
     thickness = float(request.form.get('thickness'))
     unit = request.form.get('unit', 'mm')
     if unit == 'inch':
@@ -388,7 +475,7 @@ def confirm():
 
     # Process slab image (sanitize serial number in filename)
     sanitized_serial_number = data['serial_number'].replace(" ", "_") if data['serial_number'] else "unknown"
-    output_image_path = os.path.join(app.config['OUTPUT_FOLDER'], f"processed_{sanitized_serial_number}_{timestamp}.jpg")
+    output_image_path = os.path.join(app.config['OUTPUT_FOLDER'], f"processed_{sanitized_serial_number}_{artifact_id}.jpg")
 
     # Check if user chose to continue without calibration
     continue_as_is = session.get('continue_as_is', False)
@@ -422,13 +509,22 @@ def confirm():
             </div>
             """, 500
     else:
+        from image_processor import process_slab_image, plan_for_budget
+        reduce_factor = 1
         # Attempt to process the image with QR code detection
         try:
-            process_slab_image(
-                input_path=file_mappings['slab_image'],
-                output_path=output_image_path,
-                stone_thickness_mm=thickness
-            )
+            input_image_path = file_mappings['slab_image']
+            # Estimate peak memory from the header and wait for room in the budget
+            reduce_factor, peak_bytes = plan_for_budget(input_image_path, admission_controller.budget_bytes, stone_thickness_mm=thickness)
+            if reduce_factor > 1:
+                app.logger.info(f"Decoding slab image at 1/{reduce_factor} size to fit memory budget: {input_image_path}")
+            with admission_controller.reserve(peak_bytes):
+                process_slab_image(
+                    input_path=input_image_path,
+                    output_path=output_image_path,
+                    stone_thickness_mm=thickness,
+                    reduce_factor=reduce_factor
+                )
             is_calibrated = True
         except ValueError as e:
             # Enhanced error feedback for missing markers with option to continue
@@ -436,6 +532,13 @@ def confirm():
                 # Store the slab image path and continue_as_is flag in session
                 session['continue_as_is'] = True
                 session['slab_image_path'] = file_mappings['slab_image']
+                # The markers may only be unreadable because of the memory-budget reduction
+                reduction_note = ""
+                if reduce_factor > 1:
+                    reduction_note = f"""
+                    <p><strong>Note:</strong> your photo is too large to process at full resolution within the server's memory limit, so it was checked at 1/{reduce_factor} of its resolution.
+                    The QR codes may be present but too small to read at that size. A photo taken with the QR codes filling more of the frame may work before you continue without calibration.</p>
+                    """
                 return """
                 <div class="error-box">
                     <h4>QR Code Detection Failed</h4>
@@ -445,6 +548,7 @@ def confirm():
                         <li>Poor lighting conditions affecting marker visibility.</li>
                         <li>The image being taken from an angle that obscures the markers.</li>
                     </ul>
+                    """ + reduction_note + """
                     <p><strong>What to do:</strong></p>
                     <p>- Ensure all four corners of the slab have visible QR codes (IDs 1, 18, 43, 14).</p>
                     <p>- Take the photo in good lighting, preferably with even illumination.</p>
@@ -472,6 +576,16 @@ def confirm():
                 <p><a href="/">Go Back</a></p>
             </div>
             """, 500
+        except AdmissionTimeout as e:
+            app.logger.error(f"Admission timed out: {str(e)}")
+            return """
+            <div class="error-box">
+                <h4>Server Busy</h4>
+                <p>Too many large images are being processed right now.</p>
+                <p>Please wait a minute and submit again.</p>
+                <p><a href="/">Go Back</a></p>
+            </div>
+            """, 503
         except Exception as e:
             return f"""
             <div class="error-box">
@@ -483,7 +597,7 @@ def confirm():
             """, 500
 
     # Generate PDF with ReportLab
-    pdf_path = generate_pdf(sanitized_serial_number, timestamp, data, output_image_path, support_images, company_logo_path, company_name, is_calibrated)
+    pdf_path = generate_pdf(sanitized_serial_number, artifact_id, data, output_image_path, support_images, company_logo_path, company_name, is_calibrated)
     app.logger.info(f"Generated PDF: {pdf_path}, exists: {os.path.exists(pdf_path)}")
 
     # Ensure files exist before proceeding
@@ -530,6 +644,40 @@ def reset_count():
     session['slab_count'] = 0
     return redirect(url_for('index'))
 
+# Route to report image processing memory usage and queue depth
+@app.route("/admission_status")
+def admission_status():
+    return jsonify(admission_controller.status())
+
+# Route for live marker feedback on camera preview frames
+@app.route("/marker_check", methods=["POST"])
+def marker_check():
+    from image_processor import check_markers
+    start = time.perf_counter()
+    if (request.content_length or 0) > MAX_PREVIEW_REQUEST_SIZE:
+        return jsonify(error="Preview frame exceeds 512KB."), 413
+    # Accept either a multipart 'frame' field or a raw image/jpeg body
+    if request.mimetype == 'multipart/form-data':
+        # Don't let the form parser spool an unbounded chunked body
+        if request.content_length is None:
+            return jsonify(error="Content-Length is required for multipart frames."), 411
+        frame = request.files.get('frame')
+        frame_bytes = frame.read(MAX_PREVIEW_FRAME_SIZE + 1) if frame else b''
+    else:
+        # Bounded read also covers chunked uploads without Content-Length
+        frame_bytes = request.stream.read(MAX_PREVIEW_FRAME_SIZE + 1)
+    if not frame_bytes:
+        return jsonify(error="No preview frame provided."), 400
+    if len(frame_bytes) > MAX_PREVIEW_FRAME_SIZE:
+        return jsonify(error="Preview frame exceeds 512KB."), 413
+
+    try:
+        result = check_markers(frame_bytes)
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    result['elapsed_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return jsonify(result)
+
 # Route to serve files
 @app.route('/files/<filename>')
 def serve_file(filename):
@@ -556,23 +704,32 @@ def serve_file(filename):
             </div>
             """, 404
 
-        # Determine the correct MIME type based on file extension
-        if filename.endswith('.pdf'):
-            mimetype = 'application/pdf'
-        elif filename.endswith('.jpg') or filename.endswith('.jpeg'):
-            mimetype = 'image/jpeg'
+        # Determine the MIME type from the file extension
+        mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        cache_control = IMMUTABLE_CACHE_CONTROL if UNIQUE_ARTIFACT.search(filename) else REVALIDATE_CACHE_CONTROL
+
+        if FILE_OFFLOAD == 'x-accel':
+            # nginx serves the bytes and answers If-None-Match/Range with its own
+            # ETag; hashing here would only add the worker I/O being offloaded
+            response = make_response('')
+            response.headers['X-Accel-Redirect'] = f"{X_ACCEL_PREFIX.rstrip('/')}/{urllib.parse.quote(filename)}"
+            response.headers['Content-Type'] = mimetype
         else:
-            mimetype = 'application/octet-stream'
-        
-        # Create response with Content-Disposition header
-        response = send_file(
-            file_path,
-            as_attachment=True,
-            download_name=filename,
-            mimetype=mimetype
-        )
+            etag = file_etag(file_path)
+            # conditional=True answers If-None-Match with 304 and Range with 206;
+            # with USE_X_SENDFILE the body is handed off to the front server
+            response = send_file(
+                file_path,
+                as_attachment=True,
+                download_name=filename,
+                mimetype=mimetype,
+                conditional=True,
+                etag=etag,
+                max_age=None
+            )
         response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
-        app.logger.info(f"Serving file: {file_path}, MIME type: {mimetype}, Content-Disposition: {response.headers['Content-Disposition']}")
+        response.headers['Cache-Control'] = cache_control
+        app.logger.info(f"Serving file: {file_path}, MIME type: {mimetype}, status: {response.status_code}, offload: {FILE_OFFLOAD or 'none'}")
         return response
     except Exception as e:
         app.logger.error(f"Error serving file {filename}: {str(e)}")
@@ -585,6 +742,9 @@ def serve_file(filename):
         </div>
         """, 500
 
+if PRELOAD_HEAVY:
+    warm_up()
+
 if __name__ == "__main__":
     import waitress
     print("Starting Waitress server...")
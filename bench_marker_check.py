@@ -0,0 +1,155 @@
+"""Load benchmark for the live marker check on camera preview frames.
+
+Renders a synthetic preview frame with markers 1, 18, 43 and 14 in the
+corners, JPEG-encodes it and sends it back to back for a fixed time,
+reporting latency percentiles and sustained frames per second.
+
+Targets:
+  direct  call ``check_markers`` in-process on one OpenCV thread (per core
+          detection cost, no HTTP)
+  client  POST to /marker_check through Flask's test client, including
+          request parsing, multipart handling and JSON encoding
+  --url   POST to a running server, e.g. ``gunicorn -w 4 app:app``, with
+          --concurrency clients; divide frames/s by the worker count for a
+          per-core figure
+
+    python bench_marker_check.py [--target direct|client] [--url URL]
+        [--concurrency 1] [--multipart] [--seconds 10] [--width 960] [--height 720]
+"""
+import argparse
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+import cv2
+import numpy as np
+
+from image_processor import ARUCO_DICT, REQUIRED_IDS, check_markers
+
+def make_frame(width, height, quality=80):
+    frame = np.full((height, width), 180, dtype=np.uint8)
+    size = min(width, height) // 6
+    margin = size // 3
+    aruco_dict = cv2.aruco.getPredefinedDictionary(ARUCO_DICT)
+    # Same corner layout as the slab frame: 1 TL, 18 TR, 43 BR, 14 BL
+    positions = {
+        1: (margin, margin),
+        18: (width - margin - size, margin),
+        43: (width - margin - size, height - margin - size),
+        14: (margin, height - margin - size),
+    }
+    for mid, (x, y) in positions.items():
+        pad = size // 8
+        frame[y - pad:y + size + pad, x - pad:x + size + pad] = 255
+        frame[y:y + size, x:x + size] = cv2.aruco.generateImageMarker(aruco_dict, mid, size)
+    ok, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    if not ok:
+        raise RuntimeError("JPEG encoding failed")
+    return encoded.tobytes()
+
+def encode_body(frame, multipart):
+    """Return (body, content_type) for a /marker_check request."""
+    if not multipart:
+        return frame, "image/jpeg"
+    boundary = uuid.uuid4().hex
+    body = (
+        f"--{boundary}\r\n"
+        'Content-Disposition: form-data; name="frame"; filename="frame.jpg"\r\n'
+        "Content-Type: image/jpeg\r\n\r\n"
+    ).encode() + frame + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+def direct_sender(frame):
+    def send():
+        return check_markers(frame)["all_found"]
+    return send
+
+def client_sender(frame, multipart):
+    from app import app
+    client = app.test_client()
+    body, content_type = encode_body(frame, multipart)
+    def send():
+        response = client.post("/marker_check", data=body, content_type=content_type)
+        return response.status_code == 200 and response.get_json()["all_found"]
+    return send
+
+def url_sender(frame, multipart, url):
+    body, content_type = encode_body(frame, multipart)
+    def send():
+        req = urllib.request.Request(url, data=body, headers={"Content-Type": content_type})
+        try:
+            with urllib.request.urlopen(req) as response:
+                response.read()
+                return response.status == 200
+        except urllib.error.URLError:
+            return False
+    return send
+
+def run(make_sender, seconds, concurrency):
+    """Drive `concurrency` senders until the deadline; return (latencies_ms, errors)."""
+    latencies, errors = [], [0]
+    lock = threading.Lock()
+    deadline = time.perf_counter() + seconds
+
+    def worker():
+        send = make_sender()
+        local, failed = [], 0
+        while time.perf_counter() < deadline:
+            start = time.perf_counter()
+            if not send():
+                failed += 1
+            local.append((time.perf_counter() - start) * 1000)
+        with lock:
+            latencies.extend(local)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return sorted(latencies), errors[0]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--target", choices=("direct", "client"), default="direct")
+    parser.add_argument("--url", help="benchmark a running server, e.g. http://127.0.0.1:8000/marker_check")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--multipart", action="store_true", help="send frames as a multipart 'frame' field")
+    parser.add_argument("--seconds", type=float, default=10.0)
+    parser.add_argument("--width", type=int, default=960)
+    parser.add_argument("--height", type=int, default=720)
+    args = parser.parse_args()
+
+    # One OpenCV thread so in-process figures are per core
+    cv2.setNumThreads(1)
+    frame = make_frame(args.width, args.height)
+    result = check_markers(frame)
+    if not result["all_found"]:
+        raise RuntimeError(f"Synthetic frame missing markers: {result['missing']}")
+
+    if args.url:
+        target = args.url
+        make_sender = lambda: url_sender(frame, args.multipart, args.url)
+    elif args.target == "client":
+        target = "test client /marker_check"
+        make_sender = lambda: client_sender(frame, args.multipart)
+    else:
+        target = "check_markers (in-process)"
+        make_sender = lambda: direct_sender(frame)
+
+    latencies, errors = run(make_sender, args.seconds, args.concurrency)
+
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))]
+    body = "multipart" if args.multipart else "raw"
+    print(f"target: {target}, {args.concurrency} client(s), {body} body")
+    print(f"frame: {args.width}x{args.height} JPEG, {len(frame) / 1024:.1f} KB, markers {REQUIRED_IDS}")
+    print(f"frames: {len(latencies)} in {args.seconds:.1f} s, errors: {errors}")
+    print(f"latency ms: p50 {pct(50):.1f}  p95 {pct(95):.1f}  p99 {pct(99):.1f}  max {latencies[-1]:.1f}")
+    print(f"sustained: {len(latencies) / args.seconds:.1f} frames/s")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Startup benchmark: import time and per-worker memory of `app` per startup mode.
+
+Runs each mode in a fresh interpreter with ``-X importtime`` and reports the
+total import time, the slowest imports nested under ``app`` (cv2, reportlab,
+...), the master's peak RSS and the memory of a forked worker after it has
+warmed up. The forked figures (Linux only, from /proc/<pid>/smaps_rollup) show
+what gunicorn --preload saves: USS is the memory private to that worker, PSS
+its proportional share of pages shared with the master.
+
+    python bench_startup.py [--runs 3] [--top 10]
+"""
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+MODES = {
+    "lazy": {"PRELOAD_HEAVY": "0"},
+    "preload": {"PRELOAD_HEAVY": "1"},
+}
+
+# "import time: self [us] | cumulative | imported package"
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+# Import app, then fork a "worker" that warms up as it would on its first
+# request and reports its smaps_rollup; the master reports its peak RSS.
+PROBE = r"""
+import json, os, resource, sys
+import app
+
+def smaps_kib():
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            rows = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None
+    kib = {k: int(v.split()[0]) for k, v in rows.items() if v.strip().endswith("kB")}
+    return {"uss": kib["Private_Clean"] + kib["Private_Dirty"], "pss": kib["Pss"]}
+
+r, w = os.pipe()
+pid = os.fork()
+if pid == 0:
+    os.close(r)
+    # Keep the worker's own -X importtime lines out of the master's report
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 2)
+    app.warm_up()
+    os.write(w, json.dumps(smaps_kib()).encode())
+    os._exit(0)
+os.close(w)
+with os.fdopen(r) as f:
+    worker = json.loads(f.read() or "null")
+os.waitpid(pid, 0)
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({"master_rss_kib": rss // 1024 if sys.platform == "darwin" else rss, "worker": worker}))
+"""
+
+def parse_importtime(stderr):
+    """Return (total_us, entries) where entries are (cumulative_us, depth, name).
+
+    Depth 0 entries are top-level imports; for ``app`` its depth 1 and 2
+    children (printed before it) are kept as well.
+    """
+    total_us = 0
+    entries = []
+    pending = []
+    for line in stderr.splitlines():
+        m = IMPORTTIME_LINE.match(line)
+        if not m:
+            continue
+        depth = (len(m.group(3)) - 1) // 2
+        cumulative, name = int(m.group(2)), m.group(4)
+        if depth > 0:
+            pending.append((cumulative, depth, name))
+            continue
+        total_us += cumulative
+        entries.append((cumulative, 0, name))
+        if name == "app":
+            entries.extend(e for e in pending if e[1] <= 2)
+        pending = []
+    return total_us, entries
+
+def run_once(mode_env):
+    env = dict(os.environ, **mode_env)
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", PROBE],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env, capture_output=True, text=True
+    )
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1])
+    total_us, entries = parse_importtime(proc.stderr)
+    memory = json.loads(proc.stdout.strip().splitlines()[-1])
+    return total_us, entries, memory
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    for mode, mode_env in MODES.items():
+        results = [run_once(mode_env) for _ in range(args.runs)]
+        best_total, best_entries, _ = min(results, key=lambda r: r[0])
+        master_rss = max(r[2]["master_rss_kib"] for r in results)
+        workers = [r[2]["worker"] for r in results if r[2]["worker"]]
+        print(f"== {mode} ({args.runs} runs)")
+        print(f"import time (best):   {best_total / 1000:.1f} ms")
+        print(f"master peak RSS:      {master_rss / 1024:.1f} MiB")
+        if workers:
+            print(f"forked worker USS:    {max(w['uss'] for w in workers) / 1024:.1f} MiB (private)")
+            print(f"forked worker PSS:    {max(w['pss'] for w in workers) / 1024:.1f} MiB")
+        else:
+            print("forked worker USS/PSS: n/a (needs /proc/self/smaps_rollup)")
+        top_level = sorted((e for e in best_entries if e[1] == 0), reverse=True)[:args.top]
+        for us, _, name in top_level:
+            print(f"  {us / 1000:8.1f} ms  {name}")
+        nested = sorted((e for e in best_entries if e[1] > 0), reverse=True)[:args.top]
+        if nested:
+            print("  under app:")
+            for us, depth, name in nested:
+                print(f"  {us / 1000:8.1f} ms  {'  ' * depth}{name}")
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+import os
+
+# With PRELOAD_HEAVY=1 the app (and its warmed detector, styles and heavy
+# modules) is imported once in the master and shared copy-on-write by workers
+preload_app = os.getenv('PRELOAD_HEAVY', '0') == '1'
+
+# With threads > 1 (gthread) this is only a worker liveness heartbeat; it does
+# not cut off slow requests. See ADMISSION_TIMEOUT_S in app.py for request time.
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '30'))
+
+# Threads per worker (gthread), so a request queued for memory does not block
+# /files and /marker_check in the same worker; all threads share the budget
+threads = int(os.getenv('GUNICORN_THREADS', '4'))
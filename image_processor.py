@@ -1,6 +1,7 @@
 import cv2
 import numpy as np
-from PIL import Image, ExifTags
+from PIL import Image, ExifTags, UnidentifiedImageError
+import io
 import os
 
 # Constants
@@ -12,6 +13,34 @@ TARGET_PPI       = 25.4
 CAMERA_DISTANCE_IN = 120.0
 SUPPORT_THICKNESS_IN = 0.245
 
+# Live preview frames are downscaled to this width before detection
+PREVIEW_MAX_WIDTH = 960
+# Larger preview frames are rejected before decoding (12 MP)
+PREVIEW_MAX_PIXELS = 12_000_000
+# Scratch memory of ArUco detectMarkers per source pixel with the default
+# DetectorParameters (3 adaptive-threshold scales, run in parallel). Measured
+# peak on the slab photos in static/uploads at ~48 MP: 3.2 B/px on one thread,
+# 7.3 B/px with 8 threads. High-contour images (e.g. pure noise) can use more.
+DETECTOR_BYTES_PER_PX = 8
+
+# Decode reductions for full-size slab photos, and their imread flags
+REDUCE_FACTORS = (1, 2, 4, 8)
+_REDUCED_COLOR = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8,
+}
+# JPEG DCT-domain reductions, largest first
+_REDUCED_GRAYSCALE = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2),
+)
+
+# ArUco detector shared by every call in this process
+_detector = None
+
 # Helpers
 def _dump_exif(pil_img):
     exif_raw = pil_img._getexif()
@@ -23,10 +52,30 @@ def _dump_exif(pil_img):
         lines.append(f"{tag}: {val}")
     return "\n".join(lines)
 
+def _corrected_frame_in(stone_thickness_mm, frame_width_in, frame_height_in):
+    stone_thickness_in = stone_thickness_mm / 25.4
+    total_offset_in = stone_thickness_in + SUPPORT_THICKNESS_IN
+
+    corrected_width_in = frame_width_in * (CAMERA_DISTANCE_IN - total_offset_in) / CAMERA_DISTANCE_IN
+    corrected_height_in = frame_height_in * (CAMERA_DISTANCE_IN - total_offset_in) / CAMERA_DISTANCE_IN
+    return corrected_width_in, corrected_height_in
+
+def _warped_size(corrected_width_in, corrected_height_in):
+    px_per_mm = TARGET_PPI / 25.4
+    dst_w = int(corrected_width_in * 25.4 * px_per_mm)
+    dst_h = int(corrected_height_in * 25.4 * px_per_mm)
+    return dst_w, dst_h
+
+def get_detector():
+    """Return the process-wide ArUco detector, creating it on first use."""
+    global _detector
+    if _detector is None:
+        aruco_dict = cv2.aruco.getPredefinedDictionary(ARUCO_DICT)
+        _detector  = cv2.aruco.ArucoDetector(aruco_dict, cv2.aruco.DetectorParameters())
+    return _detector
+
 def _detect_markers(gray):
-    aruco_dict = cv2.aruco.getPredefinedDictionary(ARUCO_DICT)
-    detector   = cv2.aruco.ArucoDetector(aruco_dict, cv2.aruco.DetectorParameters())
-    corners, ids, _ = detector.detectMarkers(gray)
+    corners, ids, _ = get_detector().detectMarkers(gray)
     if ids is None or len(ids) < 4:
         raise ValueError("No ArUco markers detected.")
     ids_flat = ids.flatten().tolist()
@@ -35,6 +84,111 @@ def _detect_markers(gray):
         raise ValueError(f"Missing marker IDs: {missing}")
     return corners, ids
 
+def check_markers(frame_bytes, max_width: int = PREVIEW_MAX_WIDTH) -> dict:
+    """Detect the required markers in a JPEG preview frame.
+
+    Returns per-marker found/position feedback; positions are marker centres
+    normalised to 0..1 of the frame so clients can overlay them at any scale.
+    """
+    # Check dimensions from the JPEG header before paying for a decode
+    try:
+        with Image.open(io.BytesIO(frame_bytes)) as header:
+            fmt, (w, h) = header.format, header.size
+    except Image.DecompressionBombError:
+        raise ValueError("Preview frame dimensions are too large.")
+    except (UnidentifiedImageError, OSError):
+        raise ValueError("Cannot decode preview frame.")
+    if fmt != 'JPEG':
+        raise ValueError("Preview frames must be JPEG.")
+    if w * h > PREVIEW_MAX_PIXELS:
+        raise ValueError(f"Preview frame is {w}x{h}; frames up to {PREVIEW_MAX_PIXELS // 1_000_000} MP are accepted.")
+
+    # Decode at the largest 1/2, 1/4 or 1/8 reduction that stays at least max_width wide
+    flag = cv2.IMREAD_GRAYSCALE
+    for factor, reduced_flag in _REDUCED_GRAYSCALE:
+        if w // factor >= max_width:
+            flag = reduced_flag
+            break
+    buf = np.frombuffer(frame_bytes, dtype=np.uint8)
+    gray = cv2.imdecode(buf, flag)
+    if gray is None:
+        raise ValueError("Cannot decode preview frame.")
+    h, w = gray.shape[:2]
+    if w > max_width:
+        scale = max_width / w
+        gray = cv2.resize(gray, (max_width, int(h * scale)), interpolation=cv2.INTER_AREA)
+    fh, fw = gray.shape[:2]
+
+    corners, ids, _ = get_detector().detectMarkers(gray)
+    centers = {}
+    if ids is not None:
+        for c, id_ in zip(corners, ids.flatten().tolist()):
+            if id_ in REQUIRED_IDS:
+                cx, cy = c.reshape(4,2).mean(axis=0)
+                centers[id_] = [round(float(cx) / fw, 4), round(float(cy) / fh, 4)]
+
+    markers = {
+        str(mid): {"found": mid in centers, "position": centers.get(mid)}
+        for mid in REQUIRED_IDS
+    }
+    return {
+        "markers": markers,
+        "all_found": len(centers) == len(REQUIRED_IDS),
+        "missing": [mid for mid in REQUIRED_IDS if mid not in centers],
+    }
+
+def estimate_peak_bytes(
+    width: int,
+    height: int,
+    stone_thickness_mm: float = 30.0,
+    frame_width_in: float = 153.625,
+    frame_height_in: float = 94.2,
+    debug: bool = True
+) -> int:
+    """Estimate the peak memory of `process_slab_image`.
+
+    `width` and `height` are the decoded (possibly reduced) dimensions; crops
+    are counted at full frame size. The peak is the largest of three phases:
+    - detection: BGR original (3), gray (1), pre-crop gray (1) and the
+      detector's scratch memory (DETECTOR_BYTES_PER_PX) per source pixel;
+    - warp: the three source arrays (5 per source pixel) plus, per warped
+      pixel, the warped BGR image (3), the RGB ndarray (3) and the PIL RGB
+      image, which Pillow stores at 4 bytes per pixel;
+    - debug: the source arrays and the debug copy (8 per source pixel) while
+      the warped image (3) and the PIL image (4) are still alive.
+    The detector term is measured on real slab photos, not a hard bound.
+    """
+    src = width * height
+    dst_w, dst_h = _warped_size(*_corrected_frame_in(stone_thickness_mm, frame_width_in, frame_height_in))
+    dst = dst_w * dst_h
+    phases = [
+        (3 + 1 + 1 + DETECTOR_BYTES_PER_PX) * src,
+        (3 + 1 + 1) * src + (3 + 3 + 4) * dst,
+    ]
+    if debug:
+        phases.append((3 + 1 + 1 + 3) * src + (3 + 4) * dst)
+    return max(phases)
+
+def plan_for_budget(input_path, budget_bytes: int, **estimate_kwargs) -> tuple[int, int]:
+    """Pick a decode reduction so the job's peak memory fits `budget_bytes`.
+
+    Only the image header is read. Returns (reduce_factor, peak_bytes) where
+    reduce_factor is 1, 2, 4 or 8 and is passed on to `process_slab_image`.
+    JPEGs are decoded directly at the reduced size; other formats are decoded
+    at full size first, so that transient buffer is counted too.
+    """
+    with Image.open(input_path) as img:
+        width, height = img.size
+        is_jpeg = img.format == 'JPEG'
+    for factor in REDUCE_FACTORS:
+        reduced_w, reduced_h = -(-width // factor), -(-height // factor)
+        peak = estimate_peak_bytes(reduced_w, reduced_h, **estimate_kwargs)
+        if factor > 1 and not is_jpeg:
+            peak = max(peak, 3 * width * height + 3 * reduced_w * reduced_h)
+        if peak <= budget_bytes:
+            return factor, peak
+    raise ValueError(f"Memory budget of {budget_bytes // 2**20} MB is too small to process this slab.")
+
 def resize_image_for_pdf(input_path, output_path, max_width=800):
     """Resize image to fit PDF page, maintaining aspect ratio."""
     img = Image.open(input_path)
@@ -48,19 +202,18 @@ def process_slab_image(
     stone_thickness_mm: float = 30.0,
     frame_width_in: float = 153.625,
     frame_height_in: float = 94.2,
-    debug_path: str | None = 'static/debug_markers.jpg'
+    debug_path: str | None = 'static/debug_markers.jpg',
+    reduce_factor: int = 1
 ) -> bool:
-    stone_thickness_in = stone_thickness_mm / 25.4
-    total_offset_in = stone_thickness_in + SUPPORT_THICKNESS_IN
-
-    corrected_width_in = frame_width_in * (CAMERA_DISTANCE_IN - total_offset_in) / CAMERA_DISTANCE_IN
-    corrected_height_in = frame_height_in * (CAMERA_DISTANCE_IN - total_offset_in) / CAMERA_DISTANCE_IN
+    corrected_width_in, corrected_height_in = _corrected_frame_in(
+        stone_thickness_mm, frame_width_in, frame_height_in)
 
     pil_orig = Image.open(input_path)
     exif_text = _dump_exif(pil_orig)
     pil_orig.close()
 
-    image = cv2.imread(input_path)
+    # reduce_factor > 1 decodes JPEGs at 1/2, 1/4 or 1/8 size (see plan_for_budget)
+    image = cv2.imread(input_path, _REDUCED_COLOR[reduce_factor])
     if image is None:
         raise ValueError(f"Cannot load image: {input_path}")
     gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -74,7 +227,7 @@ def process_slab_image(
     pre_top    = int(max(y_min - 10, 0))
     pre_left   = int(max(x_min - 10, 0))
     pre_right  = int(min(x_max + 10, w-1))
-    pre_bottom = int(min(y_max + PRE_MARGIN_PX, h-1))
+    pre_bottom = int(min(y_max + PRE_MARGIN_PX // reduce_factor, h-1))
 
     pre_cropped = image[pre_top:pre_bottom, pre_left:pre_right]
     gray_pre    = cv2.cvtColor(pre_cropped, cv2.COLOR_BGR2GRAY)
@@ -89,9 +242,7 @@ def process_slab_image(
         id_to_corners[14][3]
     ], dtype=np.float32)
 
-    px_per_mm = TARGET_PPI / 25.4
-    dst_w = int(corrected_width_in * 25.4 * px_per_mm)
-    dst_h = int(corrected_height_in * 25.4 * px_per_mm)
+    dst_w, dst_h = _warped_size(corrected_width_in, corrected_height_in)
 
     dst_pts = np.array([
         [0, 0],
@@ -134,6 +285,8 @@ def process_slab_image(
         f.write(f"Corrected Width (in): {corrected_width_in:.4f}\n")
         f.write(f"Corrected Height (in): {corrected_height_in:.4f}\n")
         f.write(f"Stone Thickness (mm): {stone_thickness_mm}\n")
+        if reduce_factor > 1:
+            f.write(f"Input Decoded At: 1/{reduce_factor} size (memory budget)\n")
         f.write("\nEXIF Information (original file):\n")
         f.write(exif_text + "\n")
 